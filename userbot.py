@@ -6,7 +6,10 @@ import asyncio
 import logging
 import json
 import argparse
-from datetime import datetime
+import tempfile
+from array import array
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Совместимость с Python 3.10+ ---
 try:
@@ -22,6 +25,18 @@ try:
 except ImportError:
     pass
 
+# orjson (если установлен) заметно ускоряет JSON-выгрузку
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# uvloop (если установлен) — более быстрый event loop на libuv
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from pyrogram import Client
 
 # ---------------- Logging ----------------
@@ -34,101 +49,394 @@ API_HASH = os.getenv("API_HASH", "")
 PHONE = os.getenv("PHONE_NUMBER", "")
 DATA_DIR = os.getenv("DATA_DIR", "./data")
 SESSION_PATH = os.path.join(DATA_DIR, "user")
+PEER_CACHE_PATH = os.path.join(DATA_DIR, "peer_cache.json")
 DOWNLOADS_DIR = os.path.join(os.path.expanduser("~"), "Downloads")
 
+
+def get_client(**kwargs) -> Client:
+    """Создаёт клиент Pyrogram с сохранённой сессией из DATA_DIR."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return Client(SESSION_PATH, api_id=API_ID, api_hash=API_HASH, phone_number=PHONE, **kwargs)
+
 # ---------------- Text processing ----------------
+# Регулярки компилируются один раз при загрузке модуля, а не на каждое сообщение
+# URL и t.me удаляются двумя проходами, URL первыми: t.me-шаблон забирает весь
+# токен, и без этого вместе со ссылкой ушёл бы приклеенный к ней текст
+_URL_RE = re.compile(r'https?://[^\s\n\)]+')
+_TME_RE = re.compile(r'[^\s\n]*t\.me/[^\s\n\)]+')
+# Табы заменяются на пробелы через str.replace, регулярка схлопывает только повторы
+_MULTISPACE_RE = re.compile(r'  +')
+_NL_RE = re.compile(r'\n{3,}')
+# Диапазоны эмодзи объединены: 2702-27B0 и 1F1E0-1F1FF лежат внутри 24C2-1F251,
+# а 1F300-1F5FF и 1F600-1F64F идут подряд. Меньше диапазонов — быстрее проверка символа
+_EMOJI_RE = re.compile(
+    "["
+    "\U000024C2-\U0001F251"
+    "\U0001F300-\U0001F64F"
+    "\U0001F680-\U0001F6FF"
+    "\U0001F900-\U0001F9FF"
+    "]+",
+    flags=re.UNICODE,
+)
+
+
 def normalize_whitespace(text: str) -> str:
     """Очистка лишних пробелов и пустых строк (всегда при парсинге)."""
     if not text:
         return ""
-    text = re.sub(r'[ \t]+', ' ', text)
-    lines = [line.strip() for line in text.split('\n')]
-    text = '\n'.join(lines)
-    return re.sub(r'\n{3,}', '\n\n', text).strip()
+    text = _MULTISPACE_RE.sub(' ', text.replace('\t', ' '))
+    text = '\n'.join([line.strip() for line in text.split('\n')])
+    if '\n\n\n' in text:
+        text = _NL_RE.sub('\n\n', text)
+    return text.strip()
 
 
-def remove_links(text: str) -> str:
-    """Удаляет ссылки из текста (URL и t.me)."""
-    if not text:
-        return ""
-    text = re.sub(r'https?://[^\s\n\)]+', '', text)
-    text = re.sub(r'[^\s\n]*t\.me/[^\s\n\)]+', '', text)
-    return text
+def _may_have_links(text: str) -> bool:
+    """Дешёвая проверка: без 'http' и 't.me/' ссылок в тексте быть не может."""
+    return 'http' in text or 't.me/' in text
 
 
-def remove_emoji(text: str) -> str:
-    """Удаляет эмодзи из текста."""
-    if not text:
-        return ""
-    emoji_pattern = re.compile(
-        "["
-        "\U0001F600-\U0001F64F"
-        "\U0001F300-\U0001F5FF"
-        "\U0001F680-\U0001F6FF"
-        "\U0001F1E0-\U0001F1FF"
-        "\U00002702-\U000027B0"
-        "\U000024C2-\U0001F251"
-        "\U0001F900-\U0001F9FF"
-        "]+",
-        flags=re.UNICODE,
-    )
-    return emoji_pattern.sub("", text)
+def _may_have_emoji(text: str) -> bool:
+    """Все диапазоны эмодзи вне ASCII, а str.isascii() не сканирует строку."""
+    return not text.isascii()
+
+
+# Проходы удаления под каждую комбинацию флагов (no_links, no_emoji) собираются заранее
+_REMOVE_RES = {
+    (True, False): (_URL_RE, _TME_RE),
+    (False, True): (_EMOJI_RE,),
+    (True, True): (_URL_RE, _TME_RE, _EMOJI_RE),
+}
+
+
+def _clean_message(text: str, no_links: bool, no_emoji: bool) -> str:
+    """Полная очистка текста одного сообщения за минимум проходов.
+
+    Эмодзи удаляются до нормализации пробелов, поэтому пробелы вокруг них
+    тоже схлопываются.
+    """
+    # Большинство сообщений без ссылок и эмодзи — тогда и регулярки не нужны
+    no_links = no_links and _may_have_links(text)
+    no_emoji = no_emoji and _may_have_emoji(text)
+    for remove_re in _REMOVE_RES.get((no_links, no_emoji), ()):
+        text = remove_re.sub('', text)
+    return normalize_whitespace(text)
 
 # ---------------- Core Parsing Logic ----------------
-async def parse_channel(app: Client, channel_id: int, start_date: datetime, end_date: datetime, limit: int, no_links: bool, no_emoji: bool):
-    messages_data = []
+# Те же шаблоны полей, что у strptime("%d.%m.%Y") (день допускает ведущий пробел),
+# но только с ASCII-цифрами и без парсера формата
+_DATE_RE = re.compile(r'(3[01]|[12][0-9]|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.([0-9]{4})')
+
+
+def parse_date(value: str) -> datetime:
+    """Разбирает дату DD.MM.YYYY."""
+    match = _DATE_RE.fullmatch(value)
+    if not match:
+        raise ValueError(f"date '{value}' does not match format DD.MM.YYYY")
+    day, month, year = map(int, match.groups())
+    return datetime(year, month, day)
+
+
+_CHANNEL_PREFIXES = ("https://t.me/", "http://t.me/", "@")
+
+
+def clean_channel_ref(channel: str):
+    """Приводит URL, @username или числовой ID канала к виду для get_chat."""
+    channel = channel.strip()
+    for prefix in _CHANNEL_PREFIXES:
+        if channel.startswith(prefix):
+            channel = channel[len(prefix):]
+    # Числовые ID (-100...) передаём как int, иначе Pyrogram примет их за телефон
+    # isdecimal, а не isdigit: isdigit пропускает '²' и подобные, на которых int() падает
+    if channel.startswith("-") and channel[1:].isdecimal():
+        return int(channel)
+    return channel
+
+
+class StalePeerCache(Exception):
+    """ID из кэша больше не подходит: канал переименован, удалён или закрыт."""
+
+
+def load_peer_cache() -> dict:
+    """Загружает кэш username -> {"id": ID канала, "username": его username}."""
+    try:
+        with open(PEER_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_peer_cache(cache: dict):
+    """Сохраняет кэш username -> {"id": ID канала, "username": его username}."""
+    with open(PEER_CACHE_PATH, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=4)
+
+
+async def resolve_channel_id(app: Client, channel, use_cache: bool = True) -> tuple:
+    """Возвращает (ID канала, username для проверки или None).
+
+    Для username сначала смотрится кэш. resolve_peer видит только локальную
+    сессию и не знает, жив ли канал, поэтому вместе с ID из кэша возвращается
+    сохранённый username: parse_channel сверяет его с первым сообщением истории.
+    None означает, что ID получен от get_chat и проверять нечего. Кэшируются
+    только каналы с username (ссылки-приглашения каждый раз идут через get_chat).
+    Числовой ID проверяется в сессии напрямую, без кэша.
+    """
+    if not isinstance(channel, str):
+        try:
+            await app.resolve_peer(channel)
+            return channel, None
+        except Exception as e:
+            logger.debug(f"Peer {channel} is not in the session, resolving via get_chat: {e}")
+        chat = await app.get_chat(channel)
+        return chat.id, None
+
+    key = channel.lower()
+    cache = load_peer_cache()
+    entry = cache.get(key) if use_cache else None
+    if isinstance(entry, dict) and entry.get("username"):
+        try:
+            await app.resolve_peer(entry["id"])
+            return entry["id"], entry["username"]
+        except Exception as e:
+            logger.debug(f"Cached peer {entry['id']} is not usable, resolving via get_chat: {e}")
+
+    chat = await app.get_chat(channel)
+    if chat.username:
+        cache[key] = {"id": chat.id, "username": chat.username.lower()}
+        try:
+            save_peer_cache(cache)
+        except OSError as e:
+            logger.warning(f"Could not save peer cache: {e}")
+    return chat.id, None
+
+# История читается отдельной задачей в очередь, а очистка идёт пачками в отдельном
+# потоке — загрузка следующей страницы не ждёт очистки предыдущей
+CLEAN_BATCH_SIZE = 100
+HISTORY_QUEUE_SIZE = 500
+_clean_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clean")
+
+
+def _clean_batch(batch: list, no_links: bool, no_emoji: bool) -> list:
+    """Очищает пачку (text, date) и возвращает непустые сообщения."""
+    result = []
+    # Горячий цикл: глобальные имена и методы связываем с локальными заранее
+    append = result.append
+    clean = _clean_message
+    # Дату форматируем вручную: в пачке сообщения обычно за один день,
+    # поэтому "DD.MM.YYYY " собирается один раз на день, а не strftime на каждое
+    last_day = None
+    day_prefix = ""
+    for text, msg_date in batch:
+        text = clean(text, no_links, no_emoji)
+        if text:
+            day = (msg_date.year, msg_date.month, msg_date.day)
+            if day != last_day:
+                last_day = day
+                day_prefix = f"{msg_date.day:02d}.{msg_date.month:02d}.{msg_date.year:04d} "
+            append({
+                'text': text,
+                'date': f"{day_prefix}{msg_date.hour:02d}:{msg_date.minute:02d}:{msg_date.second:02d}"
+            })
+    return result
+
+
+async def _read_history(app: Client, channel_id: int, start_date: datetime, end_date: datetime, queue: asyncio.Queue, username: str = None):
+    """Кладёт в очередь сырые (text, date) из истории канала.
+
+    Если передан username (ID взят из кэша), он сверяется с каналом первого
+    сообщения. По окончании кладёт None, при ошибке — само исключение.
+    """
+    try:
+        # Сервер сразу отдаёт историю с end_date: offset_date строгий, поэтому +1 секунда
+        history = app.get_chat_history(channel_id, offset_date=end_date + timedelta(seconds=1))
+        put = queue.put
+        async for message in history:
+            if username is not None:
+                actual = (message.chat.username or "").lower()
+                if actual != username:
+                    raise StalePeerCache(f"channel {channel_id} is now @{actual or '-'}, not @{username}")
+                username = None
+
+            msg_date = message.date
+            if msg_date < start_date:
+                break
+            if msg_date > end_date:
+                continue
+
+            text = message.text or message.caption
+            if text:
+                await put((text, msg_date))
+    except Exception as e:
+        # resolve_peer не ходит на сервер, поэтому удалённый или закрытый канал из кэша
+        # видно только здесь: ошибка до первого сообщения означает, что кэш устарел
+        if username is not None and not isinstance(e, StalePeerCache):
+            e = StalePeerCache(f"cached channel {channel_id} is not readable: {e}")
+        await queue.put(e)
+        return
+    await queue.put(None)
+
+
+async def parse_channel(app: Client, channel_id: int, start_date: datetime, end_date: datetime, limit: int, no_links: bool, no_emoji: bool, username: str = None):
+    """Асинхронный генератор очищенных сообщений канала (от новых к старым).
+
+    username (если передан) сверяется с каналом до первого сообщения;
+    при расхождении или ошибке чтения поднимается StalePeerCache.
+    """
     count = 0
+    loop = asyncio.get_running_loop()
+    # С лимитом не читаем вперёд больше, чем нужно
+    queue = asyncio.Queue(maxsize=min(limit, HISTORY_QUEUE_SIZE) if limit else HISTORY_QUEUE_SIZE)
 
     logger.info(f"Parsing channel {channel_id} (Limit: {limit or 'None'}, No-Links: {no_links}, No-Emoji: {no_emoji})")
 
-    async for message in app.get_chat_history(channel_id):
-        if limit and count >= limit:
-            break
+    reader = asyncio.create_task(_read_history(app, channel_id, start_date, end_date, queue, username))
+    try:
+        done = False
+        while not done:
+            # Пачка не больше, чем осталось до лимита, чтобы не выйти за него
+            size = min(CLEAN_BATCH_SIZE, limit - count) if limit else CLEAN_BATCH_SIZE
+            batch = []
+            item = await queue.get()
+            while True:
+                if item is None:
+                    done = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch.append(item)
+                if len(batch) >= size or queue.empty():
+                    break
+                item = queue.get_nowait()
 
-        msg_date = message.date
-        if msg_date < start_date:
-            break
-        if msg_date > end_date:
-            continue
+            if not batch:
+                break
+            cleaned = await loop.run_in_executor(_clean_executor, _clean_batch, batch, no_links, no_emoji)
+            for item in cleaned:
+                yield item
+            prev_count, count = count, count + len(cleaned)
+            if count // 50 > prev_count // 50:
+                logger.info(f"Parsed {count} messages...")
+            if limit and count >= limit:
+                break
+    finally:
+        reader.cancel()
 
-        text = message.text or message.caption or ""
+# ---------------- Output ----------------
+# Закодированный вывод копится в памяти и сбрасывается на диск крупными кусками
+WRITE_CHUNK_SIZE = 4 << 20
 
-        if text:
-            if no_links:
-                text = remove_links(text)
-            text = normalize_whitespace(text)
-            if no_emoji:
-                text = remove_emoji(text)
-
-            if text.strip():
-                messages_data.append({
-                    'text': text.strip(),
-                    'date': msg_date.strftime("%d.%m.%Y %H:%M:%S")
-                })
-                count += 1
-                if count % 50 == 0:
-                    logger.info(f"Parsed {count} messages...")
-
-    return messages_data
-
-def save_results(messages: list, filename: str, fmt: str):
-    """Сохраняет результат в Downloads или по указанному пути"""
+
+def output_path(filename: str, fmt: str) -> str:
+    """Путь к файлу результата: в Downloads или по указанному пути"""
     if not os.path.isabs(filename) and os.sep not in filename:
-        full_path = os.path.join(DOWNLOADS_DIR, f"{filename}.{fmt}")
-    else:
-        full_path = filename if filename.endswith(f".{fmt}") else f"{filename}.{fmt}"
-
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)
-
-    if fmt == 'json':
-        with open(full_path, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=4)
-    else:
-        with open(full_path, 'w', encoding='utf-8') as f:
-            for m in messages:
-                f.write(f"[{m['date']}]\n{m['text']}\n\n---\n\n")
-    
-    logger.info(f"Successfully saved {len(messages)} items to {full_path}")
+        return os.path.join(DOWNLOADS_DIR, f"{filename}.{fmt}")
+    return filename if filename.endswith(f".{fmt}") else f"{filename}.{fmt}"
+
+
+class ResultWriter:
+    """Потоково пишет сообщения в файл по мере парсинга.
+
+    Файл создаётся только при первом сообщении, поэтому пустой результат
+    не оставляет после себя файла. Запись идёт во временный файл, который
+    атомарно заменяет результат только после успешного завершения, так что
+    прерванный запуск не портит предыдущую выгрузку.
+
+    При reverse=True закодированные записи складываются в анонимный временный
+    файл рядом с выгрузкой и выписываются в обратном порядке при закрытии — в памяти остаются
+    только их смещения.
+    """
+
+    def __init__(self, filename: str, fmt: str, reverse: bool = False):
+        self.path = output_path(filename, fmt)
+        self.tmp_path = self.path + ".tmp"
+        self.fmt = fmt
+        self.reverse = reverse
+        self.count = 0
+        self._file = None
+        self._buf = bytearray()
+        self._spool = None
+        self._offsets = array('q')
+
+    def write(self, message: dict):
+        record = self._encode(message)
+        self.count += 1
+        if not self.reverse:
+            self._append(record)
+            return
+        if self._spool is None:
+            # Рядом с выгрузкой, а не в /tmp: там может быть tmpfs, то есть память
+            spool_dir = os.path.dirname(self.path)
+            os.makedirs(spool_dir, exist_ok=True)
+            self._spool = tempfile.TemporaryFile(dir=spool_dir)
+        self._offsets.append(self._spool.tell())
+        self._spool.write(record)
+
+    def _encode(self, message: dict) -> bytes:
+        if self.fmt == 'json':
+            # Тот же вид, что и у json.dump(messages, indent=4)
+            if orjson is not None:
+                fields = b",\n".join(b"        " + orjson.dumps(k) + b": " + orjson.dumps(v) for k, v in message.items())
+                return b"    {\n" + fields + b"\n    }"
+            item = json.dumps(message, ensure_ascii=False, indent=4)
+            return ("    " + item.replace("\n", "\n    ")).encode('utf-8')
+        return f"[{message['date']}]\n{message['text']}\n\n---\n\n".encode('utf-8')
+
+    def _append(self, record: bytes):
+        buf = self._buf
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.tmp_path, 'wb')
+            if self.fmt == 'json':
+                buf += b"[\n"
+        elif self.fmt == 'json':
+            buf += b",\n"
+        buf += record
+
+        if len(buf) >= WRITE_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._file.write(self._buf)
+        self._buf.clear()
+
+    def _unspool(self):
+        """Переписывает записи из временного файла в обратном порядке."""
+        spool = self._spool
+        end = spool.tell()
+        for start in reversed(self._offsets):
+            spool.seek(start)
+            self._append(spool.read(end - start))
+            end = start
+
+    def close(self, complete: bool = True):
+        if self._spool is not None:
+            try:
+                if complete:
+                    self._unspool()
+            finally:
+                self._spool.close()
+                self._spool = None
+        if self._file is None:
+            return
+        if complete:
+            if self.fmt == 'json':
+                self._buf += b"\n]"
+            self._flush()
+        self._buf.clear()
+        self._file.close()
+        self._file = None
+        if not complete:
+            os.remove(self.tmp_path)
+            return
+        os.replace(self.tmp_path, self.path)
+        logger.info(f"Successfully saved {self.count} items to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
 
 # ---------------- Execution ----------------
 async def main():
@@ -150,7 +458,7 @@ async def main():
 
     # Режим авторизации
     if args.auth:
-        async with Client(SESSION_PATH, api_id=API_ID, api_hash=API_HASH, phone_number=PHONE) as auth_app:
+        async with get_client():
             print("\n--- Authorization Successful! ---\n")
         return
 
@@ -160,39 +468,48 @@ async def main():
 
     # Парсинг дат
     try:
-        start_dt = datetime.strptime(args.start, "%d.%m.%Y")
-        end_dt = datetime.strptime(args.end, "%d.%m.%Y") if args.end else datetime.now()
+        start_dt = parse_date(args.start)
+        end_dt = parse_date(args.end) if args.end else datetime.now()
     except ValueError as e:
         logger.error(f"Date format error: {e}. Use DD.MM.YYYY")
         return
 
-    os.makedirs(DATA_DIR, exist_ok=True)
-    
-    app = Client(SESSION_PATH, api_id=API_ID, api_hash=API_HASH, phone_number=PHONE)
+    # Парсеру не нужны входящие апдейты — не тратим на них обработку
+    app = get_client(no_updates=True)
     
     async with app:
-        # Резолвим канал
-        clean_channel = args.channel.replace("https://t.me/", "").replace("http://t.me/", "").replace("@", "").strip()
-        try:
-            chat = await app.get_chat(clean_channel)
-            channel_id = chat.id
-        except Exception as e:
-            logger.error(f"Could not find channel '{args.channel}': {e}")
-            return
-
-        # Парсим
-        results = await parse_channel(app, channel_id, start_dt, end_dt, args.limit, args.no_links, args.no_emoji)
+        channel = clean_channel_ref(args.channel)
+        use_cache = True
+        while True:
+            # Резолвим канал
+            try:
+                channel_id, username = await resolve_channel_id(app, channel, use_cache)
+            except Exception as e:
+                logger.error(f"Could not find channel '{args.channel}': {e}")
+                return
+            logger.info(f"Using channel ID {channel_id}" + (" (from peer cache)" if username else ""))
 
-        if args.reverse:
-            results = list(reversed(results))
+            # Парсим и сразу пишем в файл. Устаревший кэш обнаруживается до первой
+            # записи, поэтому файл не создаётся и можно просто повторить без кэша
+            messages = parse_channel(app, channel_id, start_dt, end_dt, args.limit, args.no_links, args.no_emoji, username)
+            try:
+                with ResultWriter(args.output, args.format, reverse=args.reverse) as writer:
+                    async for m in messages:
+                        writer.write(m)
+            except StalePeerCache as e:
+                logger.warning(f"Peer cache is stale ({e}), resolving '{args.channel}' again")
+                use_cache = False
+                continue
+            break
 
-        if results:
-            save_results(results, args.output, args.format)
-        else:
+        if not writer.count:
             logger.warning("No messages found for the given criteria.")
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         pass
\ No newline at end of file